@@ -1,6 +1,15 @@
 # engine/inference.py
 from engine.knowledge_base import difficulty_weights, importance_weights
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 def calculate_priority(topic):
     difficulty = topic["difficulty"]
     importance = topic["importance"]
@@ -13,3 +22,28 @@ def calculate_priority(topic):
     # Priority formula
     raw_priority = (d_weight + i_weight) * (100 - score)
     return round(raw_priority, 2)
+
+if np is not None and njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _priority_kernel(scores, masteries, d_weights, i_weights, fatigue, interest):
+        out = np.empty_like(scores)
+        for k in range(scores.shape[0]):
+            base = round((d_weights[k] + i_weights[k]) * (100.0 - scores[k]), 2)
+            out[k] = base * (1.0 - masteries[k] * 0.5) * interest / fatigue
+        return out
+else:
+    _priority_kernel = None
+
+def calculate_priorities_vec(scores, masteries, d_weights, i_weights, fatigue, interest):
+    """Vectorized counterpart of calculate_priority with the mastery/interest/
+    fatigue adjustment applied, for whole-batch computation. Takes array-likes
+    of scores, masteries, and the already-mapped difficulty/importance weights;
+    JIT-compiled with numba when it is installed. Requires NumPy."""
+    scores = np.asarray(scores, dtype=np.float64)
+    masteries = np.asarray(masteries, dtype=np.float64)
+    d_weights = np.asarray(d_weights, dtype=np.float64)
+    i_weights = np.asarray(i_weights, dtype=np.float64)
+    if _priority_kernel is not None:
+        return _priority_kernel(scores, masteries, d_weights, i_weights, float(fatigue), float(interest))
+    base = np.round((d_weights + i_weights) * (100.0 - scores), 2)
+    return base * (1.0 - masteries * 0.5) * interest / fatigue
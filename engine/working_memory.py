@@ -1,85 +1,399 @@
 # engine/working_memory.py
-import json,os
+import json,os,time,atexit,tempfile,mmap,logging,threading,queue
+from array import array
 from datetime import datetime
 from typing import Dict,List,Any
+try:import orjson
+except ImportError:orjson=None
+try:import numpy as np
+except ImportError:np=None
+try:import msgpack
+except ImportError:msgpack=None
+
+logger=logging.getLogger(__name__)
+
+class TopicPerf:
+    # two packed columns instead of a list of per-record objects: scores as
+    # float32, timestamps as epoch-second float64 — SIMD-friendly and compact
+    __slots__=("scores","times")
+    def __init__(self):
+        self.scores=array('f')
+        self.times=array('d')
+    def __len__(self):return len(self.scores)
+    def append(self,score,ts):
+        self.scores.append(score)
+        self.times.append(ts)
+
+def _as_epoch(ts):
+    return datetime.fromisoformat(ts).timestamp() if isinstance(ts,str) else float(ts)
+
+def _as_topic_perf(data):
+    # accepts the columnar form plus both legacy row shapes (dicts and pairs)
+    tp=TopicPerf()
+    if isinstance(data,dict):
+        tp.scores=array('f',data.get("scores",()))
+        tp.times=array('d',data.get("times",()))
+        return tp
+    for item in data or []:
+        if isinstance(item,dict):tp.append(item["score"],_as_epoch(item["timestamp"]))
+        else:tp.append(item[0],_as_epoch(item[1]))
+    return tp
 
 class WorkingMemory:
     def __init__(self,student_id:str,memory_file:str=None):
         self.student_id=student_id
         self.memory_file=memory_file or f"data/student_{student_id}_memory.json"
-        self.current_session={"start_time":datetime.now(),"topics_studied":[],"performance_metrics":{}}
+        self.events_file=os.path.splitext(self.memory_file)[0]+".events.jsonl"
+        self.binary_file=os.path.splitext(self.memory_file)[0]+".mpk"
+        self._memory_dir=os.path.dirname(self.memory_file) or '.'
+        self._dir_ensured=False
+        self._events_fd=None
+        self.current_session=self._fresh_session()
         self.session_history=[]
         self.performance_history={}
         self.adaptive_parameters={"fatigue_factor":1.0,"interest_factor":1.0,"retention_rate":0.8}
+        self._mastery_cache={}
+        self._study_minutes_by_topic={}
+        self.version=0
+        self._persist_disabled=False
+        self._dirty=False
+        self._last_flush=0.0
+        self._io_lock=threading.RLock()
+        self._writer_q=None
+        self._writer_thread=None
+        self._snap_seq=0
+        self._written_seq=0
         self._load_memory()
-    
+        atexit.register(self.flush)
+
+    def _fresh_session(self):
+        self._session_start_mono=time.monotonic()
+        return {"start_time":datetime.now().isoformat(),"topics_studied":[],"performance_metrics":{}}
+
+    def reset(self):
+        # clear in place so cached holders (e.g. st.cache_resource) see the wipe
+        self.session_history.clear()
+        self.performance_history.clear()
+        self._mastery_cache.clear()
+        self._study_minutes_by_topic.clear()
+        self.adaptive_parameters={"fatigue_factor":1.0,"interest_factor":1.0,"retention_rate":0.8}
+        self.current_session=self._fresh_session()
+        self.version+=1
+        self.save_memory()
+
     def _load_memory(self):
-        if os.path.exists(self.memory_file):
+        data=self._read_snapshot()
+        if data:
+            self.session_history=data.get("session_history",[])
+            self.performance_history={t:_as_topic_perf(records) for t,records in data.get("performance_history",{}).items()}
+            self.adaptive_parameters=data.get("adaptive_parameters",self.adaptive_parameters)
+            recovered=data.get("open_session_studies") or []
+            if recovered:
+                self.session_history.append({"recovered":True,"topics_studied":recovered,"performance_metrics":{}})
+        self._replay_events()
+        # one defensive co-sort at load; afterwards record_performance appends in
+        # timestamp order, so reads skip it
+        for perf in self.performance_history.values():
+            if any(a>b for a,b in zip(perf.times,perf.times[1:])):
+                rows=sorted(zip(perf.times,perf.scores))
+                perf.times=array('d',(t for t,_ in rows))
+                perf.scores=array('f',(s for _,s in rows))
+        self._rebuild_aggregates()
+
+    def _read_snapshot(self):
+        # binary snapshot wins when msgpack is available; a legacy JSON snapshot
+        # is still read and migrates to .mpk on the next save
+        try:
+            if msgpack and os.path.exists(self.binary_file):
+                with open(self.binary_file,'rb') as f:
+                    return msgpack.unpackb(f.read(),raw=False)
+            if os.path.exists(self.memory_file):
+                with open(self.memory_file,'rb') as f:
+                    if orjson:
+                        # map the page cache directly instead of copying into a bytes object
+                        try:
+                            with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+                                if hasattr(mm,'madvise'):mm.madvise(mmap.MADV_SEQUENTIAL)
+                                return orjson.loads(memoryview(mm))
+                        except ValueError:  # empty file cannot be mapped
+                            return {}
+                    return json.loads(f.read())
+        except (OSError,ValueError) as e:
+            logger.warning("could not read memory snapshot for %s: %s",self.student_id,e)
+        return {}
+
+    def _rebuild_aggregates(self):
+        # one pass at load time so the per-topic getters stay O(1) afterwards
+        self._mastery_cache={}
+        for topic,perf in self.performance_history.items():
+            if np is not None and len(perf)>32:
+                # long trends: a zero-copy view over the packed column and one dot product
+                s=np.frombuffer(perf.scores,dtype=np.float32)
+                w=np.arange(1,len(s)+1,dtype=np.float32)
+                self._mastery_cache[topic]=(float(s@w),float(w.sum()),len(perf))
+            else:
+                for score in perf.scores:self._bump_mastery(topic,score)
+        self._study_minutes_by_topic={}
+        for session in self.session_history:
+            for entry in session.get("topics_studied",[]):
+                self._bump_study_time(entry["topic"],entry["duration_minutes"])
+
+    def _bump_study_time(self,topic_name,duration_minutes):
+        self._study_minutes_by_topic[topic_name]=self._study_minutes_by_topic.get(topic_name,0)+duration_minutes
+
+    def _bump_mastery(self,topic_name,score):
+        # running weighted sum with weight i+1 for the i-th record
+        w_sum,weights,count=self._mastery_cache.get(topic_name,(0.0,0.0,0))
+        w=count+1
+        self._mastery_cache[topic_name]=(w_sum+score*w,weights+w,w)
+
+    def _replay_events(self):
+        # events appended since the last snapshot; replay them so a crash
+        # between snapshots loses nothing
+        if not os.path.exists(self.events_file):return
+        recovered=[]
+        try:
+            with open(self.events_file,'rb') as f:
+                for line in f:
+                    if not line.strip():continue
+                    event=orjson.loads(line) if orjson else json.loads(line)
+                    if event.get("type")=="perf":
+                        perf=self.performance_history.get(event["topic"])
+                        if perf is None:perf=self.performance_history[event["topic"]]=TopicPerf()
+                        perf.append(event["score"],_as_epoch(event["timestamp"]))
+                    elif event.get("type")=="study":
+                        recovered.append({"topic":event["topic"],"duration_minutes":event["duration_minutes"],"timestamp":event["timestamp"]})
+        except (OSError,ValueError,KeyError) as e:
+            logger.warning("could not replay event log for %s: %s",self.student_id,e)
+        if recovered:
+            self.session_history.append({"recovered":True,"topics_studied":recovered,"performance_metrics":{}})
+
+    def _append_event(self,event):
+        self._append_events((event,))
+
+    def _append_events(self,events):
+        # O(event size) appends instead of rewriting the whole snapshot; a batch
+        # goes out as one os.write
+        if self._persist_disabled:return
+        try:
+            with self._io_lock:  # the writer thread may be compacting the log
+                if self._events_fd is None:
+                    self._ensure_dir()
+                    self._events_fd=os.open(self.events_file,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0o644)
+                # newline appended by the serializer, one unbuffered write per batch
+                if orjson:payload=b"".join(orjson.dumps(e,option=orjson.OPT_APPEND_NEWLINE) for e in events)
+                else:payload=b"".join(json.dumps(e).encode()+b"\n" for e in events)
+                os.write(self._events_fd,payload)
+        except OSError as e:
+            logger.warning("disabling persistence for %s, event append failed: %s",self.student_id,e)
+            self._persist_disabled=True
+
+    def _ensure_dir(self):
+        # one stat() per instance instead of one per save
+        if not self._dir_ensured:
+            os.makedirs(self._memory_dir,exist_ok=True)
+            self._dir_ensured=True
+
+    def _snapshot_state(self):
+        # built on the caller's thread so the writer never reads mutating dicts;
+        # columns serialize as plain lists so every serializer (orjson/json/msgpack) handles them
+        perf={t:{"scores":list(p.scores),"times":list(p.times)} for t,p in self.performance_history.items()}
+        # study entries of a still-open session only exist in current_session, so
+        # they must ride along or compacting the event log would drop them
+        open_studies=list(self.current_session["topics_studied"]) if self.current_session else []
+        state={"session_history":list(self.session_history),"performance_history":perf,"adaptive_parameters":dict(self.adaptive_parameters),"open_session_studies":open_studies}
+        # remember how much of the event log this snapshot covers, so the
+        # (possibly async) compaction never erases events appended afterwards
+        with self._io_lock:
+            try:events_len=os.path.getsize(self.events_file) if os.path.exists(self.events_file) else 0
+            except OSError:events_len=0
+        self._snap_seq+=1
+        return self._snap_seq,state,events_len
+
+    def _write_snapshot(self,seq,state,events_len):
+        with self._io_lock:
+            if seq<=self._written_seq:return  # a newer snapshot already landed
             try:
-                with open(self.memory_file,'r') as f:
-                    data=json.load(f)
-                    self.session_history=data.get("session_history",[])
-                    self.performance_history=data.get("performance_history",{})
-                    self.adaptive_parameters=data.get("adaptive_parameters",self.adaptive_parameters)
-            except:pass
-    
+                self._ensure_dir()
+                if msgpack:
+                    target=self.binary_file
+                    payload=msgpack.packb(state,use_bin_type=True)
+                else:
+                    target=self.memory_file
+                    payload=orjson.dumps(state) if orjson else json.dumps(state).encode()
+                # write to a sibling tmp file and rename so a crash mid-write never
+                # leaves a truncated snapshot behind
+                with tempfile.NamedTemporaryFile('wb',dir=self._memory_dir,delete=False) as tf:
+                    tf.write(payload)
+                    tf.flush()
+                    os.fsync(tf.fileno())
+                    tmp_name=tf.name
+                os.replace(tmp_name,target)
+                self._compact_events(events_len)
+                self._written_seq=seq
+                self._dirty=False
+                self._last_flush=time.monotonic()
+            except (OSError,ValueError) as e:
+                logger.warning("disabling persistence for %s, snapshot write failed: %s",self.student_id,e)
+                self._persist_disabled=True
+
     def save_memory(self):
-        os.makedirs(os.path.dirname(self.memory_file),exist_ok=True)
+        # forced synchronous write; after an unrecoverable write error, skip
+        # serializing the whole history just to fail at the filesystem again
+        if self._persist_disabled:return
+        self._write_snapshot(*self._snapshot_state())
+
+    def save_memory_async(self):
+        # hand the snapshot to a daemon writer so the caller does not wait on
+        # fsync; a size-1 queue coalesces bursts and newest wins
+        if self._persist_disabled:return
+        if self._writer_thread is None:
+            self._writer_q=queue.Queue(maxsize=1)
+            self._writer_thread=threading.Thread(target=self._writer_loop,daemon=True,name=f"memory-writer-{self.student_id}")
+            self._writer_thread.start()
+        item=self._snapshot_state()
+        try:self._writer_q.put_nowait(item)
+        except queue.Full:
+            try:self._writer_q.get_nowait()
+            except queue.Empty:pass
+            try:self._writer_q.put_nowait(item)
+            except queue.Full:pass
+
+    def _writer_loop(self):
+        while True:
+            item=self._writer_q.get()
+            if item is None:break
+            self._write_snapshot(*item)
+
+    def _compact_events(self,covered_len):
+        # drop only the prefix the snapshot covers; events appended after the
+        # snapshot state was captured survive for the next replay
         try:
-            with open(self.memory_file,'w') as f:
-                json.dump({"session_history":self.session_history,"performance_history":self.performance_history,"adaptive_parameters":self.adaptive_parameters},f,default=str)
-        except:pass
+            self._close_events_fd()
+            if not os.path.exists(self.events_file):return
+            if os.path.getsize(self.events_file)<=covered_len:
+                open(self.events_file,'wb').close()
+                return
+            with open(self.events_file,'rb') as f:
+                f.seek(covered_len)
+                tail=f.read()
+            # rewrite via tmp+replace so a crash mid-compaction keeps the tail
+            with tempfile.NamedTemporaryFile('wb',dir=self._memory_dir,delete=False) as tf:
+                tf.write(tail)
+                tf.flush()
+                os.fsync(tf.fileno())
+                tmp_name=tf.name
+            os.replace(tmp_name,self.events_file)
+        except OSError as e:
+            logger.warning("could not compact event log for %s: %s",self.student_id,e)
+
+    def _close_events_fd(self):
+        with self._io_lock:
+            if self._events_fd is not None:
+                os.close(self._events_fd)
+                self._events_fd=None
+
+    def flush(self):
+        if self._dirty:self.save_memory()
+        else:self._close_events_fd()
+
+    def __del__(self):
+        try:self._close_events_fd()
+        except OSError:pass
+
+    def _maybe_flush(self):
+        # coalesce bursts of record_* calls into at most one rewrite per second
+        if time.monotonic()-self._last_flush>1.0:self.save_memory()
     
     def start_study_session(self):
         if self.current_session and len(self.current_session["topics_studied"])>0:self.end_study_session()
-        self.current_session={"start_time":datetime.now(),"topics_studied":[],"performance_metrics":{}}
-    
+        self.current_session=self._fresh_session()
+
     def end_study_session(self):
         if not self.current_session:return {}
-        self.current_session["end_time"]=datetime.now()
-        self.current_session["duration"]=(self.current_session["end_time"]-self.current_session["start_time"]).total_seconds()/3600
-        self.session_history.append(self.current_session.copy())
-        self.save_memory()
-        return self.current_session.copy()
+        # hand the dict over to the history instead of copying it twice;
+        # the next record_*/start_study_session creates a fresh session
+        finished=self.current_session
+        finished["end_time"]=datetime.now().isoformat()
+        finished["duration"]=(time.monotonic()-self._session_start_mono)/3600
+        self.session_history.append(finished)
+        self.current_session=None
+        self._dirty=True
+        self.flush()
+        return finished
     
     def record_topic_study(self,topic_name:str,duration_minutes:int):
         if not self.current_session:self.start_study_session()
-        self.current_session["topics_studied"].append({"topic":topic_name,"duration_minutes":duration_minutes,"timestamp":datetime.now()})
+        # time_ns skips the datetime construction that datetime.now() pays per event
+        entry={"topic":topic_name,"duration_minutes":duration_minutes,"timestamp":time.time_ns()}
+        self.current_session["topics_studied"].append(entry)
+        self._bump_study_time(topic_name,duration_minutes)
+        self._append_event({"type":"study","topic":topic_name,"duration_minutes":duration_minutes,"timestamp":entry["timestamp"]})
+        self.version+=1
+        self._dirty=True
+
+    def record_topic_study_bulk(self,items):
+        # amortizes the per-call bookkeeping of record_topic_study over one
+        # list-extend and one event write; items are (topic_name, minutes) pairs
+        if not self.current_session:self.start_study_session()
+        now=time.time_ns()
+        entries=[{"topic":t,"duration_minutes":d,"timestamp":now} for t,d in items]
+        self.current_session["topics_studied"].extend(entries)
+        for t,d in items:self._bump_study_time(t,d)
+        self._append_events([{"type":"study","topic":t,"duration_minutes":d,"timestamp":now} for t,d in items])
+        self.version+=1
+        self._dirty=True
     
     def record_performance(self,topic_name:str,score:float):
-        data={"score":score,"timestamp":datetime.now()}
-        if topic_name not in self.performance_history:self.performance_history[topic_name]=[]
-        self.performance_history[topic_name].append(data)
-        if topic_name not in self.current_session["performance_metrics"]:self.current_session["performance_metrics"][topic_name]=[]
-        self.current_session["performance_metrics"][topic_name].append(data)
-        self.save_memory()
+        if not self.current_session:self.start_study_session()
+        now=time.time()
+        perf=self.performance_history.get(topic_name)
+        if perf is None:perf=self.performance_history[topic_name]=TopicPerf()
+        perf.append(score,now)
+        self.current_session["performance_metrics"].setdefault(topic_name,[]).append({"score":score,"timestamp":now})
+        self._bump_mastery(topic_name,score)
+        self._append_event({"type":"perf","topic":topic_name,"score":score,"timestamp":now})
+        self.version+=1
+        self._dirty=True
     
     def get_study_time_for_topic(self,topic_name:str):
-        mins=0
-        for s in self.session_history:mins+=sum(e["duration_minutes"] for e in s.get("topics_studied",[]) if e["topic"]==topic_name)
-        mins+=sum(e["duration_minutes"] for e in self.current_session.get("topics_studied",[]) if e["topic"]==topic_name)
-        return mins/60
+        return self._study_minutes_by_topic.get(topic_name,0)/60
+
+    def known_topics(self):
+        # every topic with a recorded score or study time, straight from the
+        # maintained indexes — no walk over session events
+        return sorted(set(self.performance_history)|set(self._study_minutes_by_topic))
     
     def get_performance_trend(self,topic_name:str):
-        if topic_name not in self.performance_history:return []
-        return sorted(self.performance_history[topic_name],key=lambda x:x["timestamp"])
+        # kept in insertion == timestamp order, so no sort per call; rows are
+        # materialized only here, on the display path. Timestamps come out as
+        # datetime objects so pandas wraps them without a string-parse pass.
+        perf=self.performance_history.get(topic_name)
+        if perf is None:return []
+        return [{"score":s,"timestamp":datetime.fromtimestamp(t)} for s,t in zip(perf.scores,perf.times)]
     
     def update_adaptive_parameters(self,fatigue_factor=None,interest_factor=None,retention_rate=None):
-        if fatigue_factor:self.adaptive_parameters["fatigue_factor"]=max(0.1,min(2.0,fatigue_factor))
-        if interest_factor:self.adaptive_parameters["interest_factor"]=max(0.1,min(2.0,interest_factor))
-        if retention_rate:self.adaptive_parameters["retention_rate"]=max(0,min(1.0,retention_rate))
-        self.save_memory()
+        # `is not None` so 0.0 is a legal value; only persist when something changed,
+        # since Streamlit re-sends identical slider values on every rerun
+        params=self.adaptive_parameters
+        changed=False
+        if fatigue_factor is not None:
+            value=max(0.1,min(2.0,fatigue_factor))
+            if value!=params["fatigue_factor"]:params["fatigue_factor"]=value;changed=True
+        if interest_factor is not None:
+            value=max(0.1,min(2.0,interest_factor))
+            if value!=params["interest_factor"]:params["interest_factor"]=value;changed=True
+        if retention_rate is not None:
+            value=max(0,min(1.0,retention_rate))
+            if value!=params["retention_rate"]:params["retention_rate"]=value;changed=True
+        if changed:
+            self._dirty=True
+            self._maybe_flush()
     
     def get_recommended_break(self,study_duration:float):
         return int(5+(study_duration*10*self.adaptive_parameters["fatigue_factor"]))
     
     def estimate_topic_mastery(self,topic_name:str):
-        if topic_name not in self.performance_history or not self.performance_history[topic_name]:return 0.0
-        scores=[r["score"] for r in self.get_performance_trend(topic_name)]
-        if not scores:return 0.0
-        w_sum,weights=0,0
-        for i,s in enumerate(scores):
-            w=i+1
-            w_sum+=s*w
-            weights+=w
+        w_sum,weights,_=self._mastery_cache.get(topic_name,(0.0,0.0,0))
+        if not weights:return 0.0
         return min(1.0,(w_sum/weights)/100)
@@ -1,8 +1,11 @@
-import streamlit as st,sys,os,uuid,pandas as pd,plotly.express as px
+import streamlit as st,sys,os,uuid
 from datetime import datetime
+# pandas/plotly are imported lazily inside the blocks that use them, so a
+# cold start (or a tab3-only visit) does not pay their import cost
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
-from engine.inference import calculate_priority
+from engine.inference import calculate_priorities_vec
+from engine.knowledge_base import difficulty_weights,importance_weights
 from utils.scheduler import allocate_study_time
 from engine.working_memory import WorkingMemory
 
@@ -10,8 +13,55 @@ st.set_page_config(page_title="Exam Prep",layout="wide")
 st.markdown("<div class='big-title'>📘 Intelligent Exam Preparation</div><div class='subtitle'>Study planning based on performance</div><style>.big-title{font-size:36px!important;color:#4CAF50;font-weight:bold}.subtitle{font-size:18px!important;color:#666}</style>",unsafe_allow_html=True)
 
 if 'student_id' not in st.session_state: st.session_state.student_id=str(uuid.uuid4())[:8]
-if 'memory' not in st.session_state: st.session_state.memory=WorkingMemory(student_id=st.session_state.student_id)
-memory=st.session_state.memory
+
+@st.cache_resource
+def get_memory(student_id):
+    # one WorkingMemory (and one disk load) per student across all reruns
+    return WorkingMemory(student_id=student_id)
+
+memory=get_memory(st.session_state.student_id)
+
+@st.cache_data(show_spinner=False)
+def cached_mastery(student_id,topic_name,version):
+    # version bumps on every memory mutation, so reruns with unchanged state hit the cache
+    return get_memory(student_id).estimate_topic_mastery(topic_name)
+
+@st.cache_data(show_spinner=False)
+def prioritized_topics(topics,fatigue,interest):
+    # one batched pass over all topics, cached on the pure inputs so a
+    # resubmit with unchanged values is a lookup
+    import pandas as pd
+    tdf=pd.DataFrame.from_records(topics)
+    tdf["priority"]=calculate_priorities_vec(
+        tdf["score"].fillna(50),tdf["mastery"].fillna(0),
+        tdf["difficulty"].map(difficulty_weights).fillna(1),
+        tdf["importance"].map(importance_weights).fillna(1),
+        fatigue,interest)
+    return tdf.to_dict("records")
+
+@st.cache_data(show_spinner=False)
+def known_topics(student_id,version):
+    # rebuilt only when the memory version moves, not on every widget tick
+    return get_memory(student_id).known_topics()
+
+@st.cache_data(show_spinner=False)
+def plan_figures(plan):
+    # figures are a pure function of the plan; cache the serialized dict form
+    # so unchanged plans re-render without rebuilding Figure objects
+    import plotly.graph_objects as go
+    names=[t["name"] for t in plan]
+    pie=go.Figure(go.Pie(labels=names,values=[t["allocated_hours"] for t in plan]))
+    pie.update_layout(title="Time")
+    bar=go.Figure(go.Bar(x=names,y=[(t.get("mastery") or 0)*100 for t in plan]))
+    bar.update_layout(title="Mastery %",yaxis_title="%")
+    return pie.to_dict(),bar.to_dict()
+
+@st.cache_data(show_spinner=False)
+def plan_csv(plan):
+    # encoded once per unique plan, not on every rerun that shows the button
+    import pandas as pd
+    df=pd.DataFrame(plan).rename(columns={"name":"Topic","priority":"Priority","allocated_hours":"Hours","mastery":"Mastery"})
+    return df.to_csv(index=False).encode('utf-8')
 
 tab1,tab2,tab3=st.tabs(["📝 Plan","📊 Analytics","🧠 Working Memory"])
 
@@ -24,19 +74,20 @@ with tab1:
             current_date=st.date_input("🕒 Today",value=datetime.today())
         with c2:
             daily_hours=st.slider("⏱️ Hours/Day",1,10,4)
-            topic_count=st.number_input("📚 Topics",1,20,5)
 
         st.markdown("### 📘 Topics")
-        topics=[]
-        for i in range(topic_count):
-            with st.expander(f"Topic {i+1}"):
-                name=st.text_input("Name",key=f"name_{i}")
-                mastery=memory.estimate_topic_mastery(name) if name else 0
-                if mastery>0: st.info(f"Mastery: {mastery*100:.1f}%")
-                score=st.slider("Score",0,100,50,key=f"score_{i}")
-                diff=st.selectbox("Difficulty",["easy","medium","hard"],key=f"diff_{i}")
-                imp=st.selectbox("Importance",["optional","important","core"],key=f"imp_{i}")
-                if name: topics.append({"name":name,"score":score,"difficulty":diff,"importance":imp,"mastery":mastery})
+        # one data_editor instead of four widgets per topic; rows are added and
+        # removed in the grid itself (num_rows="dynamic"), so no topic-count input
+        edited=st.data_editor(
+            [{"name":"","score":50,"difficulty":"easy","importance":"optional"} for _ in range(5)],
+            num_rows="dynamic",use_container_width=True,column_config={
+                "name":st.column_config.TextColumn("Topic"),
+                "score":st.column_config.NumberColumn("Score",min_value=0,max_value=100,step=1,required=True,default=50),
+                "difficulty":st.column_config.SelectboxColumn("Difficulty",options=["easy","medium","hard"],required=True),
+                "importance":st.column_config.SelectboxColumn("Importance",options=["optional","important","core"],required=True),
+            })
+        topics=[dict(r,mastery=cached_mastery(st.session_state.student_id,r["name"],memory.version))
+                for r in edited if r.get("name")]
 
         with st.expander("🧠 Adaptive"):
             f=st.slider("Fatigue",0.1,2.0,memory.adaptive_parameters["fatigue_factor"],0.1)
@@ -49,56 +100,61 @@ with tab1:
     if submitted and topics:
         memory.start_study_session()
         profile={"current_date":current_date,"exam_date":exam_date,"daily_study_hours":daily_hours,"topics":topics}
-        
-        for topic in profile["topics"]:
-            base=calculate_priority(topic)
-            m=topic["mastery"]
-            f,i=memory.adaptive_parameters["fatigue_factor"],memory.adaptive_parameters["interest_factor"]
-            topic["priority"]=base*(1.0-m*0.5)*i/f
+
+        f,i=memory.adaptive_parameters["fatigue_factor"],memory.adaptive_parameters["interest_factor"]
+        profile["topics"]=prioritized_topics(topics,f,i)
 
         plan=allocate_study_time(profile)
-        for topic in plan:
-            memory.record_topic_study(topic["name"],int(topic["allocated_hours"]*60))
-        memory.save_memory()
+        memory.record_topic_study_bulk([(t["name"],int(t["allocated_hours"]*60)) for t in plan])
+        memory.save_memory_async()
 
+        st.session_state.plan=plan
+        st.session_state.plan_days_left=(exam_date-current_date).days
         st.success("Plan generated!")
-        
-        df=pd.DataFrame(plan)
-        df=df.rename(columns={"name":"Topic","priority":"Priority","allocated_hours":"Hours","mastery":"Mastery"})
-        if "mastery" in df.columns:
-            df["Mastery"]=df["mastery"].apply(lambda x:f"{x*100:.1f}%" if x is not None else "0%")
-        
+
+    @st.fragment
+    def render_plan():
+        # only this block reruns on interactions inside it; form widget tweaks
+        # elsewhere no longer rebuild the DataFrame and figures
+        plan=st.session_state.get("plan")
+        if not plan: return
+        # a DataFrame bought nothing for ~20 rows: st.dataframe takes the record
+        # list directly (labels/formatting via column_config)
         st.markdown("### ✅ Plan")
-        st.dataframe(df,use_container_width=True)
-        
+        st.dataframe(plan,use_container_width=True,column_config={
+            "name":"Topic","score":"Score","difficulty":"Difficulty","importance":"Importance",
+            "priority":"Priority","allocated_hours":"Hours",
+            "mastery":st.column_config.NumberColumn("Mastery",format="percent"),
+        })
+
+        pie,bar=plan_figures(plan)
         c1,c2=st.columns(2)
-        with c1: st.plotly_chart(px.pie(df,names="Topic",values="Hours",title="Time"),use_container_width=True)
-        with c2:
-            if "mastery" in df.columns:
-                mdf=df[["Topic","mastery"]].copy()
-                mdf["mastery"]*=100
-                st.plotly_chart(px.bar(mdf,x="Topic",y="mastery",title="Mastery %",labels={"mastery":"%"}),use_container_width=True)
+        with c1: st.plotly_chart(pie,use_container_width=True)
+        with c2: st.plotly_chart(bar,use_container_width=True)
+
+        st.download_button("📥 Download CSV",plan_csv(plan),"plan.csv","text/csv")
 
-        st.download_button("📥 Download CSV",df.to_csv(index=False).encode('utf-8'),"plan.csv","text/csv")
-        
+        # all three values computed once, before any widget context
+        total_hours=sum(t["allocated_hours"] for t in plan)
+        break_min=memory.get_recommended_break(total_hours)
+        days_left=st.session_state.plan_days_left
         c1,c2,c3=st.columns(3)
-        total=df["Hours"].sum()
-        with c1: st.metric("Hours",f"{total:.1f}")
-        with c2: st.metric("Break",f"{memory.get_recommended_break(total)}min")
-        with c3: st.metric("Days Left",(exam_date-current_date).days)
+        with c1: st.metric("Hours",f"{total_hours:.1f}")
+        with c2: st.metric("Break",f"{break_min}min")
+        with c3: st.metric("Days Left",days_left)
+
+    render_plan()
 
 with tab2:
     st.markdown("### 📈 Performance")
     
-    topics=set()
-    topics.update(memory.performance_history.keys())
-    topics.update(entry["topic"] for entry in memory.current_session.get("topics_studied",[]))
-    
-    if not topics:
-        st.info("No data yet. Create a plan first.")
-    else:
+    topics=known_topics(st.session_state.student_id,memory.version)
+
+    @st.fragment
+    def render_topic_analytics(topics):
+        # switching topics reruns only this block, not the whole script
         selected=st.selectbox("Topic",list(topics))
-        
+
         if selected:
             perf=memory.get_performance_trend(selected)
             hours=memory.get_study_time_for_topic(selected)
@@ -108,25 +164,34 @@ with tab2:
                 st.metric("Study Time",f"{hours:.1f}hrs")
                 if perf: st.metric("Latest Score",f"{perf[-1]['score']}/100")
             with c2:
-                st.metric("Mastery",f"{memory.estimate_topic_mastery(selected)*100:.1f}%")
+                st.metric("Mastery",f"{cached_mastery(st.session_state.student_id,selected,memory.version)*100:.1f}%")
                 if len(perf)>=2:
                     imp=perf[-1]["score"]-perf[0]["score"]
                     st.metric("Improvement",f"{imp:+.1f}",delta=imp)
             
             if perf:
-                df=pd.DataFrame(perf)
-                df["timestamp"]=pd.to_datetime(df["timestamp"])
-                st.plotly_chart(px.line(df,x="timestamp",y="score",title=f"{selected} Performance"),use_container_width=True)
+                import pandas as pd,plotly.express as px
+                df=pd.DataFrame(perf)  # timestamps arrive as datetimes, no parse needed
+                if len(df)>2000:
+                    # long histories: bucket to daily means so the browser draws
+                    # a bounded number of points
+                    df=df.resample("1D",on="timestamp").mean().dropna().reset_index()
+                st.plotly_chart(px.line(df,x="timestamp",y="score",render_mode="webgl",title=f"{selected} Performance"),use_container_width=True)
             else:
                 st.info(f"No scores for {selected} yet.")
-    
+
+    if not topics:
+        st.info("No data yet. Create a plan first.")
+    else:
+        render_topic_analytics(topics)
+
     st.markdown("### 📝 New Score")
     with st.form("record_score"):
         topic=st.selectbox("Topic",list(topics) if topics else ["No topics"])
         score=st.slider("Score",0,100,75)
         if st.form_submit_button("Record") and topic!="No topics":
             memory.record_performance(topic,score)
-            memory.save_memory()
+            memory.save_memory_async()
             st.success(f"Score recorded: {score}")
             st.rerun()
 
@@ -137,7 +202,12 @@ with tab3:
     with c1:
         st.info(f"ID: {st.session_state.student_id}")
         if st.button("Reset"):
-            st.session_state.memory=WorkingMemory(student_id=st.session_state.student_id)
+            memory.reset()
+            cached_mastery.clear()
+            # the plan lives in session_state now; drop it so render_plan does
+            # not keep showing output computed from the wiped memory
+            st.session_state.pop("plan",None)
+            st.session_state.pop("plan_days_left",None)
             st.success("Memory reset")
             st.rerun()
     